@@ -6,10 +6,15 @@ Also collects Docker Compose container status (Up/Down)
 """
 
 import os
+import heapq
+import threading
 import time
+from operator import itemgetter
 import psutil
 import docker
-from prometheus_client import Gauge, start_http_server
+from docker.utils import version_gte
+from prometheus_client import REGISTRY, start_http_server
+from prometheus_client.core import GaugeMetricFamily
 import logging
 from concurrent.futures import ThreadPoolExecutor
 
@@ -20,17 +25,132 @@ logger = logging.getLogger(__name__)
 # Use host /proc if mounted
 if os.path.exists("/host/proc"):
     logger.info("Using host /proc for psutil (reading host processes)")
-    psutil.PROCFS_PATH = "/host/proc"
+    PROCFS_PATH = "/host/proc"
 else:
     logger.info("Using container's /proc for psutil (container processes only)")
+    PROCFS_PATH = "/proc"
+psutil.PROCFS_PATH = PROCFS_PATH
+
+# Use host /sys if mounted, so container cgroups are visible
+SYSFS_PATH = "/host/sys" if os.path.exists("/host/sys") else "/sys"
+CGROUP_ROOT = f"{SYSFS_PATH}/fs/cgroup"
+
+CLOCK_TICKS = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+CPU_COUNT = psutil.cpu_count()
+
+TOP_PROCESS_COUNT = 5
+MOUNT_REFRESH_INTERVAL = 60
+PSEUDO_FS_PREFIXES = ('/proc', '/sys', '/dev', '/run')
+
+DOCKER_STATS_WORKERS = 32
+# Stats workers plus the event stream and the main loop, so no request waits on or discards a connection
+DOCKER_POOL_SIZE = DOCKER_STATS_WORKERS + 2
+COMPOSE_PROJECT_LABEL = 'com.docker.compose.project'
+# States the daemon reports with State.Running=true
+RUNNING_STATES = ('running', 'paused', 'restarting')
+DOCKER_VERSION_TTL = 300
+
+
+MEMINFO_KEYS = frozenset((
+    b'MemTotal', b'MemFree', b'MemAvailable', b'Buffers', b'Cached', b'SReclaimable',
+    b'SwapTotal', b'SwapFree',
+))
+
+
+def process_name(procfs, pid, comm):
+    """Return a process name the way psutil's Process.name() does
+
+    The kernel truncates comm to 15 bytes; in that case the cmdline basename is used
+    when it extends comm.
+    """
+    name = comm.decode(errors='replace')
+    if len(comm) < 15:
+        return name
+    try:
+        fd = os.open(procfs + str(pid).encode() + b'/cmdline', os.O_RDONLY)
+        try:
+            cmdline = os.read(fd, 4096)
+        finally:
+            os.close(fd)
+    except OSError:
+        return name
+    extended_name = os.path.basename(cmdline.split(b'\0', 1)[0]).decode(errors='replace')
+    return extended_name if extended_name.startswith(name) else name
+
+
+class ProcReader:
+    """Procfs files kept open across ticks and re-read with a single pread each"""
+
+    def __init__(self, procfs_path, names=('meminfo', 'stat')):
+        self._fds = {name: os.open(f"{procfs_path}/{name}", os.O_RDONLY) for name in names}
+
+    def read(self, name, size=8192):
+        return os.pread(self._fds[name], size, 0)
+
+    def cpu_times(self):
+        """Return (idle, total) jiffies from the aggregate cpu line of /proc/stat"""
+        buf = self.read('stat', 256)
+        # Fixed layout: "cpu  " then single-space separated counters; guest/guest_nice are
+        # already counted in user/nice and stay in the unsplit tail
+        user, nice, system, idle, iowait, irq, softirq, steal, _ = buf[5:buf.index(b'\n')].split(b' ', 8)
+        idle = int(idle)
+        return idle, int(user) + int(nice) + int(system) + idle + int(iowait) + int(irq) + int(softirq) + int(steal)
+
+    def meminfo(self):
+        """Return the MEMINFO_KEYS fields of /proc/meminfo in bytes"""
+        values = {}
+        for line in self.read('meminfo').split(b'\n'):
+            key, _, rest = line.partition(b':')
+            if key in MEMINFO_KEYS:
+                values[key] = int(rest.split()[0]) * 1024
+        return values
+
+
+class MetricStore:
+    """Latest gauge values, exported by this custom collector on every scrape
+
+    Collectors store plain floats keyed by (metric name, label values); a single dict
+    assignment is atomic under the GIL, so the hot path takes no locks at all.
+    """
+
+    def __init__(self):
+        self._metrics = {}  # name -> (documentation, label names)
+        self._values = {}
+
+    def gauge(self, name, documentation, labelnames=()):
+        self._metrics[name] = (documentation, list(labelnames))
+        if not labelnames:
+            self._values[(name, ())] = 0.0  # Like an unlabelled Gauge, export 0 until first set
+        return name
+
+    def set(self, name, value, *labelvalues):
+        self._values[(name, labelvalues)] = value
+
+    def describe(self):
+        # Lets RestrictedRegistry route filtered scrapes (?name[]=...) to this collector
+        return [GaugeMetricFamily(name, documentation, labels=labelnames)
+                for name, (documentation, labelnames) in self._metrics.items()]
+
+    def collect(self):
+        families = {
+            name: GaugeMetricFamily(name, documentation, labels=labelnames)
+            for name, (documentation, labelnames) in self._metrics.items()
+        }
+        for (name, labelvalues), value in self._values.copy().items():
+            families[name].add_metric(labelvalues, value)
+        return families.values()
+
 
 class MetricsCollector:
     def __init__(self):
+        self.metrics = MetricStore()
+
         # Initialize Docker client
         try:
             self.docker_client = None
             try:
-                self.docker_client = docker.DockerClient(base_url='unix://var/run/docker.sock', version='auto')
+                self.docker_client = docker.DockerClient(base_url='unix://var/run/docker.sock', version='auto', max_pool_size=DOCKER_POOL_SIZE)
                 self.docker_client.ping()
                 logger.info("Docker client initialized successfully")
             except Exception as e:
@@ -39,7 +159,7 @@ class MetricsCollector:
                     from docker import APIClient
                     api_client = APIClient(base_url='unix://var/run/docker.sock')
                     api_client.ping()
-                    self.docker_client = docker.DockerClient(base_url='unix://var/run/docker.sock')
+                    self.docker_client = docker.DockerClient(base_url='unix://var/run/docker.sock', max_pool_size=DOCKER_POOL_SIZE)
                     logger.info("Docker client initialized successfully with API client test")
                 except Exception as e2:
                     logger.error(f"All Docker connection methods failed: {e2}")
@@ -49,130 +169,258 @@ class MetricsCollector:
             self.docker_client = None
 
         # System Metrics
-        self.cpu_usage = Gauge('system_cpu_usage_percent', 'Average CPU usage across all cores')
-        self.ram_usage = Gauge('system_ram_usage_bytes', 'RAM usage in bytes')
-        self.ram_total = Gauge('system_ram_total_bytes', 'Total RAM in bytes')
-        self.ram_usage_percent = Gauge('system_ram_usage_percent', 'RAM usage percentage')
+        self.cpu_usage = self.metrics.gauge('system_cpu_usage_percent', 'Average CPU usage across all cores')
+        self.ram_usage = self.metrics.gauge('system_ram_usage_bytes', 'RAM usage in bytes')
+        self.ram_total = self.metrics.gauge('system_ram_total_bytes', 'Total RAM in bytes')
+        self.ram_usage_percent = self.metrics.gauge('system_ram_usage_percent', 'RAM usage percentage')
 
-        self.swap_usage = Gauge('system_swap_usage_bytes', 'Swap usage in bytes')
-        self.swap_total = Gauge('system_swap_total_bytes', 'Total swap in bytes')
-        self.swap_usage_percent = Gauge('system_swap_usage_percent', 'Swap usage percentage')
+        self.swap_usage = self.metrics.gauge('system_swap_usage_bytes', 'Swap usage in bytes')
+        self.swap_total = self.metrics.gauge('system_swap_total_bytes', 'Total swap in bytes')
+        self.swap_usage_percent = self.metrics.gauge('system_swap_usage_percent', 'Swap usage percentage')
 
-        self.disk_usage = Gauge('system_disk_usage_bytes', 'Disk usage in bytes', ['mountpoint'])
-        self.disk_total = Gauge('system_disk_total_bytes', 'Total disk space in bytes', ['mountpoint'])
-        self.disk_usage_percent = Gauge('system_disk_usage_percent', 'Disk usage percentage', ['mountpoint'])
+        self.disk_usage = self.metrics.gauge('system_disk_usage_bytes', 'Disk usage in bytes', ['mountpoint'])
+        self.disk_total = self.metrics.gauge('system_disk_total_bytes', 'Total disk space in bytes', ['mountpoint'])
+        self.disk_usage_percent = self.metrics.gauge('system_disk_usage_percent', 'Disk usage percentage', ['mountpoint'])
 
-        self.container_cpu_usage = Gauge('container_cpu_usage_percent', 'Container CPU usage percentage', ['container_name', 'project'])
-        self.container_memory_usage = Gauge('container_memory_usage_bytes', 'Container memory usage in bytes', ['container_name', 'project'])
-        self.container_memory_limit = Gauge('container_memory_limit_bytes', 'Container memory limit in bytes', ['container_name', 'project'])
+        self.container_cpu_usage = self.metrics.gauge('container_cpu_usage_percent', 'Container CPU usage percentage', ['container_name', 'project'])
+        self.container_memory_usage = self.metrics.gauge('container_memory_usage_bytes', 'Container memory usage in bytes', ['container_name', 'project'])
+        self.container_memory_limit = self.metrics.gauge('container_memory_limit_bytes', 'Container memory limit in bytes', ['container_name', 'project'])
 
         # Docker Compose container status
-        self.compose_container_status = Gauge(
+        self.compose_container_status = self.metrics.gauge(
             'docker_compose_container_status',
             'Docker Compose container status: 1=running, 0=stopped',
             ['container_name', 'project']
         )
-        self.compose_container_status_flat = Gauge(
+        self.compose_container_status_flat = self.metrics.gauge(
             'docker_compose_container_status_flat',
             'Container status for Grafana status panel (1=running, 0=stopped)',
             ['name']
         )
 
         # Top processes metrics
-        self.top_cpu_processes = Gauge('top_process_cpu_usage_percent', 'Top 5 processes by CPU usage', ['pid', 'name'])
-        self.top_memory_processes = Gauge('top_process_memory_usage_bytes', 'Top 5 processes by Memory usage', ['pid', 'name'])
+        self.top_cpu_processes = self.metrics.gauge('top_process_cpu_usage_percent', 'Top 5 processes by CPU usage', ['pid', 'name'])
+        self.top_memory_processes = self.metrics.gauge('top_process_memory_usage_bytes', 'Top 5 processes by Memory usage', ['pid', 'name'])
+        REGISTRY.register(self.metrics)
+
+        self.proc_reader = ProcReader(PROCFS_PATH)
+
+        # Mountpoints reported by collect_disk_usage; re-enumerated every MOUNT_REFRESH_INTERVAL
+        self._mounts = []
+        self._mounts_refreshed_at = None
+
+        # utime+stime per (pid, starttime) from the previous top-processes sweep
+        self._last_proc_cpu_times = {}
+        self._last_proc_sample_time = None
+
+        # /version body reused for DOCKER_VERSION_TTL seconds
+        self._docker_version = None
+        self._docker_version_expires_at = 0
+
+        # Previous cpu_stats per container ID; one-shot stats carry no precpu sample
+        self._last_container_cpu_stats = {}
+
+        # cgroup v2 directory per container ID, or None to fall back to the stats API
+        self._container_cgroups = {}
+
+        # Worker threads for concurrent stats requests, reused across Docker ticks
+        self._stats_pool = ThreadPoolExecutor(max_workers=DOCKER_STATS_WORKERS, thread_name_prefix='docker-stats')
+
+        # (name, project) per container ID; only rename/destroy can change it
+        self._container_meta = {}
+        if self.docker_client:
+            threading.Thread(target=self._watch_container_events, name='docker-events', daemon=True).start()
+
+    def _watch_container_events(self):
+        """Keep compose status and cached container metadata in sync with the Docker event stream"""
+        filters = {'type': 'container', 'event': ['create', 'start', 'die', 'rename', 'destroy']}
+        while True:
+            try:
+                events = self.docker_client.api.events(decode=True, filters=filters)
+                # Scan after subscribing so nothing between the scan and the first event is lost
+                self.collect_docker_compose_status()
+                for event in events:
+                    self._handle_container_event(event)
+            except Exception as e:
+                logger.warning(f"Docker event stream interrupted: {e}")
+            # Events may have been missed while disconnected
+            self._container_meta.clear()
+            time.sleep(5)
+
+    def _handle_container_event(self, event):
+        action = event.get('Action')
+        actor = event.get('Actor', {})
+        attributes = actor.get('Attributes', {})
+
+        if action in ('rename', 'destroy'):
+            self._container_meta.pop(actor.get('ID'), None)
+            if action == 'rename':
+                self.collect_docker_compose_status()
+            return
+
+        project = attributes.get(COMPOSE_PROJECT_LABEL)
+        if not project:
+            return
+        container_name = attributes.get('name', actor.get('ID', '')[:12])
+        status = 1 if action == 'start' else 0
+        self.metrics.set(self.compose_container_status, status, container_name, project)
+        self.metrics.set(self.compose_container_status_flat, status, container_name)
+
+    def _get_container_meta(self, container):
+        """Return cached (name, project) for a /containers/json entry"""
+        container_id = container['Id']
+        meta = self._container_meta.get(container_id)
+        if meta is None:
+            names = container.get('Names')
+            name = names[0].lstrip('/') if names else container_id[:12]
+            project = (container.get('Labels') or {}).get(COMPOSE_PROJECT_LABEL, 'unknown')
+            meta = self._container_meta[container_id] = (name, project)
+        return meta
 
     def test_docker_connectivity(self):
         if not self.docker_client:
             return False, "Docker client not initialized"
         try:
-            version_info = self.docker_client.version()
-            containers = self.docker_client.containers.list()
+            now = time.monotonic()
+            if self._docker_version is None or now >= self._docker_version_expires_at:
+                self._docker_version = self.docker_client.api.version()
+                self._docker_version_expires_at = now + DOCKER_VERSION_TTL
+            version_info = self._docker_version
+            containers = self.docker_client.api.containers()
             return True, f"Connected to Docker {version_info.get('Version', 'unknown')}, found {len(containers)} containers"
         except Exception as e:
             return False, f"Docker connectivity test failed: {e}"
 
     def collect_system_cpu(self):
         try:
-            if os.path.exists("/host/proc/stat"):  # Host /proc is mounted
-                with open("/host/proc/stat", "r") as f:
-                    cpu_line = f.readline().split()[1:]
-                    cpu_times = list(map(int, cpu_line))
+            idle_time, total_time = self.proc_reader.cpu_times()
 
-                idle_time = cpu_times[3]
-                total_time = sum(cpu_times)
+            if not hasattr(self, "_last_total"):
+                self._last_total = total_time
+                self._last_idle = idle_time
+                return
 
-                if not hasattr(self, "_last_total"):
-                    self._last_total = total_time
-                    self._last_idle = idle_time
-                    return
+            total_diff = total_time - self._last_total
+            idle_diff = idle_time - self._last_idle
 
-                total_diff = total_time - self._last_total
-                idle_diff = idle_time - self._last_idle
+            cpu_percent = (1 - idle_diff / total_diff) * 100.0
+            self.metrics.set(self.cpu_usage, cpu_percent)
 
-                cpu_percent = (1 - idle_diff / total_diff) * 100.0
-                self.cpu_usage.set(cpu_percent)
-
-                self._last_total = total_time
-                self._last_idle = idle_time
-            else:
-                cpu_percent = psutil.cpu_percent(interval=None)
-                self.cpu_usage.set(cpu_percent)
+            self._last_total = total_time
+            self._last_idle = idle_time
 
         except Exception as e:
             logger.error(f"Error collecting CPU metrics: {e}")
 
     def collect_system_memory(self):
         try:
-            memory = psutil.virtual_memory()
-            self.ram_usage.set(memory.used)
-            self.ram_total.set(memory.total)
-            self.ram_usage_percent.set(memory.percent)
+            memory = self.proc_reader.meminfo()
+            total = memory[b'MemTotal']
+            free = memory[b'MemFree']
+            # Same accounting as psutil.virtual_memory()
+            used = total - free - memory[b'Buffers'] - memory[b'Cached'] - memory.get(b'SReclaimable', 0)
+            if used < 0:
+                used = total - free
+            self.metrics.set(self.ram_usage, used)
+            self.metrics.set(self.ram_total, total)
+            self.metrics.set(self.ram_usage_percent, round((total - memory[b'MemAvailable']) / total * 100, 1))
         except Exception as e:
             logger.error(f"Error collecting memory metrics: {e}")
 
     def collect_system_swap(self):
         try:
-            swap = psutil.swap_memory()
-            self.swap_usage.set(swap.used)
-            self.swap_total.set(swap.total)
-            self.swap_usage_percent.set(swap.percent)
+            memory = self.proc_reader.meminfo()
+            total = memory[b'SwapTotal']
+            used = total - memory[b'SwapFree']
+            self.metrics.set(self.swap_usage, used)
+            self.metrics.set(self.swap_total, total)
+            self.metrics.set(self.swap_usage_percent, round(used / total * 100, 1) if total else 0.0)
         except Exception as e:
             logger.error(f"Error collecting swap metrics: {e}")
 
     def collect_disk_usage(self):
         try:
-            for partition in psutil.disk_partitions():
+            now = time.monotonic()
+            if self._mounts_refreshed_at is None or now - self._mounts_refreshed_at >= MOUNT_REFRESH_INTERVAL:
+                self._mounts = [
+                    partition.mountpoint for partition in psutil.disk_partitions()
+                    if not partition.mountpoint.startswith(PSEUDO_FS_PREFIXES)
+                ]
+                self._mounts_refreshed_at = now
+
+            for mountpoint in self._mounts:
                 try:
-                    if partition.mountpoint.startswith(('/proc', '/sys', '/dev', '/run')):
-                        continue
-                    usage = psutil.disk_usage(partition.mountpoint)
-                    self.disk_usage.labels(mountpoint=partition.mountpoint).set(usage.used)
-                    self.disk_total.labels(mountpoint=partition.mountpoint).set(usage.total)
-                    self.disk_usage_percent.labels(mountpoint=partition.mountpoint).set(usage.percent)
+                    st = os.statvfs(mountpoint)
+                    total = st.f_blocks * st.f_frsize
+                    used = (st.f_blocks - st.f_bfree) * st.f_frsize
+                    # Same as psutil.disk_usage(): percent of the space available to unprivileged users
+                    total_user = used + st.f_bavail * st.f_frsize
+                    self.metrics.set(self.disk_usage, used, mountpoint)
+                    self.metrics.set(self.disk_total, total, mountpoint)
+                    self.metrics.set(self.disk_usage_percent, round(used / total_user * 100, 1) if total_user else 0.0, mountpoint)
                 except PermissionError:
                     continue
                 except Exception as e:
-                    logger.warning(f"Error collecting disk metrics for {partition.mountpoint}: {e}")
+                    logger.warning(f"Error collecting disk metrics for {mountpoint}: {e}")
         except Exception as e:
             logger.error(f"Error collecting disk metrics: {e}")
 
     def collect_top_processes(self):
         try:
-            processes = []
-            for proc in psutil.process_iter(['pid', 'name', 'cpu_percent', 'memory_info']):
-                try:
-                    processes.append(proc.info)
-                except (psutil.NoSuchProcess, psutil.AccessDenied):
+            now = time.monotonic()
+            elapsed = now - self._last_proc_sample_time if self._last_proc_sample_time else None
+            cpu_times = {}
+            # Bounded min-heaps of (value, pid, comm); the smallest of the current top-N sits at [0].
+            # CPU is ranked by raw tick deltas, and only the winners are converted to percent and str.
+            top_cpu = []
+            top_mem = []
+            procfs = os.fsencode(PROCFS_PATH) + b'/'
+            for entry in os.listdir(procfs):
+                if not entry.isdigit():
                     continue
-
-            top_cpu = sorted(processes, key=lambda p: p['cpu_percent'], reverse=True)[:5]
-            for proc in top_cpu:
-                self.top_cpu_processes.labels(pid=str(proc['pid']), name=proc['name']).set(proc['cpu_percent'])
-
-            top_mem = sorted(processes, key=lambda p: p['memory_info'].rss, reverse=True)[:5]
-            for proc in top_mem:
-                self.top_memory_processes.labels(pid=str(proc['pid']), name=proc['name']).set(proc['memory_info'].rss)
+                try:
+                    fd = os.open(procfs + entry + b'/stat', os.O_RDONLY)
+                    try:
+                        data = os.read(fd, 1024)
+                    finally:
+                        os.close(fd)
+                except OSError:
+                    continue  # Process exited or is not readable
+
+                # comm may contain spaces and parentheses; fields resume after the last ')'
+                name_end = data.rindex(b')')
+                comm = data[data.index(b'(') + 1:name_end]
+                # Fields up to rss only; the ~30 trailing fields are never looked at
+                fields = data[name_end + 2:].split(maxsplit=22)
+                pid = int(entry)
+                ticks = int(fields[11]) + int(fields[12])  # utime + stime
+                key = (pid, fields[19])  # starttime guards against PID reuse
+                cpu_times[key] = ticks
+                previous = self._last_proc_cpu_times.get(key)
+                cpu_ticks = ticks - previous if previous is not None else 0
+                rss = int(fields[21]) * PAGE_SIZE
+
+                # Compare against the heap minimum before building a tuple; most PIDs stop here
+                if len(top_cpu) < TOP_PROCESS_COUNT:
+                    heapq.heappush(top_cpu, (cpu_ticks, pid, comm))
+                elif cpu_ticks > top_cpu[0][0]:
+                    heapq.heapreplace(top_cpu, (cpu_ticks, pid, comm))
+                # Kernel threads have no RSS and can never rank by memory; they still compete on CPU
+                if rss:
+                    if len(top_mem) < TOP_PROCESS_COUNT:
+                        heapq.heappush(top_mem, (rss, pid, comm))
+                    elif rss > top_mem[0][0]:
+                        heapq.heapreplace(top_mem, (rss, pid, comm))
+
+            self._last_proc_cpu_times = cpu_times
+            self._last_proc_sample_time = now
+
+            for cpu_ticks, pid, comm in top_cpu:
+                cpu_percent = round(cpu_ticks / CLOCK_TICKS / elapsed * 100.0, 1) if elapsed else 0.0
+                self.metrics.set(self.top_cpu_processes, cpu_percent, str(pid), process_name(procfs, pid, comm))
+
+            for rss, pid, comm in top_mem:
+                self.metrics.set(self.top_memory_processes, rss, str(pid), process_name(procfs, pid, comm))
 
         except Exception as e:
             logger.error(f"Error collecting top processes: {e}")
@@ -184,66 +432,108 @@ class MetricsCollector:
             if system_delta > 0:
                 online_cpus = stats['cpu_stats'].get('online_cpus', len(stats['cpu_stats']['cpu_usage'].get('percpu_usage', [1])))
                 if online_cpus == 0:
-                    online_cpus = psutil.cpu_count()
+                    online_cpus = CPU_COUNT
                 return (cpu_delta / system_delta) * online_cpus * 100.0
             return 0.0
         except (KeyError, ZeroDivisionError, TypeError) as e:
             logger.warning(f"Error calculating CPU usage: {e}")
             return 0.0
 
+    def _find_container_cgroup(self, container_id):
+        """Locate a container's cgroup v2 directory for the systemd and cgroupfs drivers"""
+        for path in (f"{CGROUP_ROOT}/system.slice/docker-{container_id}.scope", f"{CGROUP_ROOT}/docker/{container_id}"):
+            if os.path.exists(f"{path}/cpu.stat"):
+                return path
+        return None
+
+    def read_cgroup_stats(self, cgroup, system_cpu_usage, host_memory_total):
+        """Build the subset of a Docker stats body used here from cgroup v2 files"""
+        with open(f"{cgroup}/cpu.stat", "rb") as f:
+            usage_usec = int(f.readline().split()[1])  # usage_usec is always the first line
+        with open(f"{cgroup}/memory.current", "rb") as f:
+            memory_usage = int(f.read())
+        with open(f"{cgroup}/memory.max", "rb") as f:
+            memory_max = f.read().strip()
+        # Like the Docker API, report host memory as the limit for unconstrained containers
+        memory_limit = host_memory_total if memory_max == b'max' else int(memory_max)
+        return {
+            'cpu_stats': {
+                'cpu_usage': {'total_usage': usage_usec * 1000},
+                'system_cpu_usage': system_cpu_usage,
+                'online_cpus': CPU_COUNT,
+            },
+            'memory_stats': {'usage': memory_usage, 'limit': memory_limit},
+        }
+
     def collect_docker_metrics(self):
         if not self.docker_client:
             return
         try:
-            self.docker_client.ping()
+            self.docker_client.api.ping()
         except Exception as e:
             logger.warning(f"Docker daemon not responding: {e}")
             return
 
+        # one_shot needs API 1.41 (Docker 20.10); docker-py raises InvalidVersion below that
+        stats_options = {'one_shot': True} if version_gte(self.docker_client.api.api_version, '1.41') else {}
+
         def process_container(container):
+            container_id = container['Id']
+            container_name, project_name = self._get_container_meta(container)
             try:
-                labels = container.labels
-                project_name = labels.get('com.docker.compose.project', 'unknown')
-                container_name = container.name
-                stats = container.stats(stream=False)
-                cpu_usage_percent = self.calculate_container_cpu_usage(stats)
-                self.container_cpu_usage.labels(container_name=container_name, project=project_name).set(cpu_usage_percent)
-                memory_usage = stats['memory_stats'].get('usage', 0)
-                memory_limit = stats['memory_stats'].get('limit', 0)
-                self.container_memory_usage.labels(container_name=container_name, project=project_name).set(memory_usage)
-                self.container_memory_limit.labels(container_name=container_name, project=project_name).set(memory_limit)
+                if container_id not in self._container_cgroups:
+                    self._container_cgroups[container_id] = self._find_container_cgroup(container_id)
+                cgroup = self._container_cgroups[container_id]
+                if cgroup:
+                    stats = self.read_cgroup_stats(cgroup, system_cpu_usage, host_memory_total)
+                else:
+                    stats = self.docker_client.api.stats(container_id, stream=False, **stats_options)
+                stats['precpu_stats'] = self._last_container_cpu_stats.get(container_id, stats['cpu_stats'])
+                self._last_container_cpu_stats[container_id] = stats['cpu_stats']
+                self.metrics.set(self.container_cpu_usage, self.calculate_container_cpu_usage(stats), container_name, project_name)
+                self.metrics.set(self.container_memory_usage, stats['memory_stats'].get('usage', 0), container_name, project_name)
+                self.metrics.set(self.container_memory_limit, stats['memory_stats'].get('limit', 0), container_name, project_name)
             except Exception as e:
-                logger.warning(f"Error collecting metrics for container {container.name}: {e}")
+                logger.warning(f"Error collecting metrics for container {container_name}: {e}")
+
+        try:
+            containers = self.docker_client.api.containers()
+        except Exception as e:
+            logger.warning(f"Error listing containers: {e}")
+            return
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            executor.map(process_container, self.docker_client.containers.list())
+        live_ids = set(map(itemgetter('Id'), containers))
+        for cache in (self._last_container_cpu_stats, self._container_cgroups):
+            for container_id in list(cache):
+                if container_id not in live_ids:
+                    del cache[container_id]
+
+        try:
+            # Host CPU time in nanoseconds, sampled once per tick like Docker's system_cpu_usage
+            system_cpu_usage = self.proc_reader.cpu_times()[1] * 1_000_000_000 // CLOCK_TICKS
+            host_memory_total = self.proc_reader.meminfo()[b'MemTotal']
+        except Exception as e:
+            logger.error(f"Error reading host CPU time and memory for container metrics: {e}")
+            return
+
+        # Drain the iterator so the tick waits for every container, as the old with-block did
+        for _ in self._stats_pool.map(process_container, containers):
+            pass
 
     def collect_docker_compose_status(self, project_name=None):
         if not self.docker_client:
             return
 
         try:
-            containers = self.docker_client.containers.list(all=True)
+            # The list response already carries State, so no per-container inspect is needed.
+            # The daemon filters to compose-managed containers (optionally one project).
+            label = f"{COMPOSE_PROJECT_LABEL}={project_name}" if project_name else COMPOSE_PROJECT_LABEL
+            containers = self.docker_client.api.containers(all=True, filters={'label': [label]})
             for container in containers:
-                labels = container.labels
-                proj = labels.get('com.docker.compose.project', 'unknown')
-
-                if project_name and proj != project_name:
-                    continue
-
-                try:
-                    container.reload()  # Refresh container info
-                    running = container.attrs['State'].get('Running', False)
-                    status = 1 if running else 0
-                except Exception as e:
-                    logger.warning(f"Error reading state for container {container.name}: {e}")
-                    status = 0
-
-                self.compose_container_status.labels(
-                    container_name=container.name,
-                    project=proj
-                ).set(status)
-                self.compose_container_status_flat.labels(name=container.name).set(status)
+                container_name, proj = self._get_container_meta(container)
+                status = 1 if container.get('State') in RUNNING_STATES else 0
+                self.metrics.set(self.compose_container_status, status, container_name, proj)
+                self.metrics.set(self.compose_container_status_flat, status, container_name)
 
         except Exception as e:
             logger.error(f"Error collecting Docker Compose container status: {e}")
@@ -255,9 +545,7 @@ class MetricsCollector:
         self.collect_disk_usage()
         self.collect_top_processes()
 
-        # Always collect container status every loop
-        if self.docker_client:
-            self.collect_docker_compose_status()
+        # Compose container status is maintained by the docker-events thread
 
         # Collect heavy Docker metrics less often
         if collect_docker and self.docker_client:
@@ -267,24 +555,45 @@ class MetricsCollector:
 
 def main():
     metrics_port = int(os.getenv('METRICS_PORT', 8000))
-    collection_interval = int(os.getenv('COLLECTION_INTERVAL', 5))
-    docker_collection_interval = int(os.getenv('DOCKER_COLLECTION_INTERVAL', 30))
+    collection_interval = float(os.getenv('COLLECTION_INTERVAL', 5))
+    docker_collection_interval = float(os.getenv('DOCKER_COLLECTION_INTERVAL', 30))
+    realtime_priority = int(os.getenv('REALTIME_PRIORITY', 0))
+
+    if realtime_priority:
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(realtime_priority))
+            logger.info(f"Collection loop running with SCHED_FIFO priority {realtime_priority}")
+        except (AttributeError, OSError) as e:
+            logger.warning(f"Could not set SCHED_FIFO priority {realtime_priority}: {e}")
 
     logger.info(f"Starting metrics collector on port {metrics_port}")
     start_http_server(metrics_port)
     collector = MetricsCollector()
-    loop_counter = 0
+
+    # Fixed-cadence deadlines: slow collections shorten the following sleep instead of shifting every tick
+    interval_ns = int(collection_interval * 1_000_000_000)
+    docker_interval_ns = int(docker_collection_interval * 1_000_000_000)
+    next_tick = time.monotonic_ns()
+    next_docker_collection = next_tick + docker_interval_ns
 
     try:
         while True:
-            loop_counter += collection_interval
-            collect_docker_now = (loop_counter % docker_collection_interval == 0)
+            collect_docker_now = next_tick >= next_docker_collection
+            if collect_docker_now:
+                next_docker_collection += docker_interval_ns
             collector.collect_all_metrics(collect_docker=collect_docker_now)
-            time.sleep(collection_interval)
+
+            next_tick += interval_ns
+            now = time.monotonic_ns()
+            if next_tick > now:
+                time.sleep((next_tick - now) / 1_000_000_000)
+            else:
+                logger.warning(f"Collection overran its {collection_interval}s interval by {(now - next_tick) / 1_000_000_000:.2f}s")
+                next_tick = now
+                next_docker_collection = max(next_docker_collection, now)
     except KeyboardInterrupt:
         logger.info("Shutting down metrics collector...")
 
 if __name__ == "__main__":
-    psutil.cpu_percent(interval=0.1)
     main()
 